@@ -1,5 +1,11 @@
+import heapq
 import os.path
 import pickle
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 class MyDB:
 
@@ -21,3 +27,195 @@ class MyDB:
         arr = self.loadStrings()
         arr.append(s)
         self.saveStrings(arr)
+
+def siblingFilename(filename, tag):
+    root, ext = os.path.splitext(filename)
+    return "%s.%s%s" % (root, tag, ext)
+
+def shardFilename(filename, index, generation=0):
+    if generation:
+        return siblingFilename(filename, "g%d.%d" % (generation, index))
+    return siblingFilename(filename, "%d" % index)
+
+def shardIndex(s, shardCount):
+    return zlib.crc32(str(s).encode("utf-8")) % shardCount
+
+def readLockPid(name):
+    try:
+        with open(name) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+def processAlive(pid):
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+# Each shard is a MyDB file holding (seq, s) pairs, where seq is the global
+# insertion order; a write only rewrites the one shard its string hashes to.
+# seq comes from a shared counter file, and writers (across instances and
+# processes) take a lock file around counter + shard updates so every shard
+# stays sorted by seq. The metadata file records the shard count, so a caller
+# using a stale count fails instead of routing strings to the wrong shard, and
+# the generation that names the current set of shard files.
+class ShardedMyDB:
+
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, filename, shardCount, maxWorkers=None):
+        if shardCount < 1:
+            raise ValueError("shardCount must be at least 1")
+        self.fname = filename
+        self.shardCount = shardCount
+        self.maxWorkers = maxWorkers or shardCount
+        self.lockName = siblingFilename(filename, "lock")
+        self.meta = MyDB(siblingFilename(filename, "meta"))
+        self.generation = self.loadLayout()
+        self.shards = [MyDB(shardFilename(filename, i, self.generation)) for i in range(shardCount)]
+        self.counter = MyDB(siblingFilename(filename, "seq"))
+
+    # returns the current generation, recording [shardCount, 0] on first open
+    def loadLayout(self):
+        meta = self.meta.loadStrings()
+        if not meta:
+            with self.writeLock():
+                meta = self.meta.loadStrings()
+                if not meta:
+                    meta = [self.shardCount, 0]
+                    self.meta.saveStrings(meta)
+                    return 0
+        shardCount, generation = meta
+        if shardCount != self.shardCount:
+            raise ValueError("%s has %d shards, not %d" % (self.fname, shardCount, self.shardCount))
+        missing = [shardFilename(self.fname, i, generation) for i in range(shardCount)
+                   if not os.path.isfile(shardFilename(self.fname, i, generation))]
+        if missing:
+            raise ValueError("missing shard files: %s" % ", ".join(missing))
+        return generation
+
+    @contextmanager
+    def writeLock(self):
+        deadline = time.monotonic() + self.LOCK_TIMEOUT
+        while True:
+            try:
+                with open(self.lockName, 'x') as f:
+                    f.write("%d" % os.getpid())
+                break
+            except FileExistsError:
+                if self.breakStaleLock():
+                    continue
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(
+                        "could not acquire %s; if no writer is running it was left by a crashed "
+                        "process and can be deleted" % self.lockName)
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.remove(self.lockName)
+
+    # Only a lock whose holder is known to be dead is broken. An empty or
+    # unreadable lock, or one held by a live (or, off POSIX, unknown) process,
+    # is waited on. The lock is renamed aside before removal so two breakers
+    # cannot both remove it; if the renamed file turns out to belong to a new
+    # holder, it is linked back.
+    def breakStaleLock(self):
+        pid = readLockPid(self.lockName)
+        if pid is None or processAlive(pid):
+            return False
+        stale = "%s.stale.%d" % (self.lockName, os.getpid())
+        try:
+            os.rename(self.lockName, stale)
+        except OSError:
+            return False
+        try:
+            if readLockPid(stale) != pid:
+                try:
+                    os.link(stale, self.lockName)
+                except OSError:
+                    pass
+                return False
+            return True
+        finally:
+            os.remove(stale)
+
+    # callers must hold writeLock
+    def takeSeq(self):
+        arr = self.counter.loadStrings()
+        if arr:
+            seq = arr[0]
+        else:
+            parts = self.loadShards()
+            seq = 1 + max((part[-1][0] for part in parts if part), default=-1)
+        self.counter.saveStrings([seq + 1])
+        return seq
+
+    def shardIndex(self, s):
+        return shardIndex(s, self.shardCount)
+
+    def loadShards(self):
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            return list(pool.map(lambda shard: shard.loadStrings(), self.shards))
+
+    def loadStrings(self, ordered=True):
+        parts = self.loadShards()
+        if ordered:
+            entries = heapq.merge(*parts, key=lambda entry: entry[0])
+        else:
+            entries = (entry for part in parts for entry in part)
+        return [s for seq, s in entries]
+
+    def saveStrings(self, arr):
+        parts = [[] for _ in self.shards]
+        for seq, s in enumerate(arr):
+            parts[self.shardIndex(s)].append((seq, s))
+        with self.writeLock():
+            with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+                list(pool.map(lambda pair: pair[0].saveStrings(pair[1]), zip(self.shards, parts)))
+            self.counter.saveStrings([len(arr)])
+
+    def saveString(self, s):
+        with self.writeLock():
+            self.shards[self.shardIndex(s)].saveString((self.takeSeq(), s))
+
+# The new layout is written under the next generation's file names and the
+# switch is the single os.replace of the metadata file: a crash before it
+# leaves the old layout in use, and a crash after it only leaves unreferenced
+# old-generation files behind. Sequence numbers are kept, so the counter stays valid.
+def rebalanceShards(filename, oldCount, newCount):
+    if newCount < 1:
+        raise ValueError("newCount must be at least 1")
+    db = ShardedMyDB(filename, oldCount)
+    with db.writeLock():
+        parts = [[] for _ in range(newCount)]
+        for seq, s in heapq.merge(*db.loadShards(), key=lambda entry: entry[0]):
+            parts[shardIndex(s, newCount)].append((seq, s))
+        generation = db.generation + 1
+        newNames = [shardFilename(filename, i, generation) for i in range(newCount)]
+        metaTmp = db.meta.fname + ".tmp"
+        try:
+            for name, part in zip(newNames, parts):
+                MyDB(name).saveStrings(part)
+            MyDB(metaTmp).saveStrings([newCount, generation])
+        except Exception:
+            for name in newNames + [metaTmp]:
+                if os.path.isfile(name):
+                    os.remove(name)
+            raise
+        os.replace(metaTmp, db.meta.fname)
+        for shard in db.shards:
+            os.remove(shard.fname)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print("usage: python mydb.py <filename> <old shard count> <new shard count>")
+        print("if this times out on <name>.lock<ext> and no writer is running, delete that lock file and retry")
+        sys.exit(1)
+    rebalanceShards(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
@@ -12,6 +12,29 @@ class SquirrelDB:
         self.connection = sqlite3.connect("squirrel_db.db")
         self.connection.row_factory = dict_factory
         self.cursor = self.connection.cursor()
+        if not self.hasChangeLog():
+            self.createChangeLog()
+
+    def hasChangeLog(self):
+        self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'squirrel_changes'")
+        return self.cursor.fetchone() is not None
+
+    # seeds a create for every existing squirrel so replaying from seq 0 rebuilds the table;
+    # the write lock plus re-check keeps two first connections from seeding twice
+    def createChangeLog(self):
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if not self.hasChangeLog():
+                self.cursor.execute(
+                    "CREATE TABLE squirrel_changes "
+                    "(seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, id INTEGER, name TEXT, size TEXT)")
+                self.cursor.execute(
+                    "INSERT INTO squirrel_changes (op, id, name, size) "
+                    "SELECT 'create', id, name, size FROM squirrels ORDER BY id")
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
 
     def getSquirrels(self):
         self.cursor.execute("SELECT * FROM squirrels ORDER BY id")
@@ -25,17 +48,37 @@ class SquirrelDB:
     def createSquirrel(self, name, size):
         data = [name, size]
         self.cursor.execute("INSERT INTO squirrels (name, size) VALUES (?, ?)", data)
+        self.logChange("create", self.cursor.lastrowid, name, size)
         self.connection.commit()
         return None
 
     def updateSquirrel(self, squirrelId, name, size):
         data = [name, size, squirrelId]
         self.cursor.execute("UPDATE squirrels SET name = ?, size = ? WHERE id = ?", data)
+        if self.cursor.rowcount:
+            self.logChange("update", squirrelId, name, size)
         self.connection.commit()
         return None
 
     def deleteSquirrel(self, squirrelId):
         data = [squirrelId]
         self.cursor.execute("DELETE FROM squirrels WHERE id = ?", data)
+        if self.cursor.rowcount:
+            self.logChange("delete", squirrelId, None, None)
         self.connection.commit()
         return None
+
+    # the change row is written in the same transaction as the mutation it records;
+    # squirrelId is bound as-is so the id INTEGER column normalizes ids like "1.0"
+    def logChange(self, op, squirrelId, name, size):
+        data = [op, squirrelId, name, size]
+        self.cursor.execute("INSERT INTO squirrel_changes (op, id, name, size) VALUES (?, ?, ?, ?)", data)
+
+    def getChanges(self, since, limit=1000):
+        data = [since, limit]
+        self.cursor.execute("SELECT * FROM squirrel_changes WHERE seq > ? ORDER BY seq LIMIT ?", data)
+        return self.cursor.fetchall()
+
+    def getLastSeq(self):
+        self.cursor.execute("SELECT COALESCE(MAX(seq), 0) AS seq FROM squirrel_changes")
+        return self.cursor.fetchone()["seq"]
@@ -1,23 +1,165 @@
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import parse_qs
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
 from squirrel_db import SquirrelDB
 
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class AdmissionController:
+
+    MAX_TRACKED_CLIENTS = 10000
+
+    # long-polls mostly sit idle waiting for a write, so they get their own limit and do not
+    # count toward maxInFlight; otherwise idle replicas could starve the writes that wake them
+    KINDS = ("reads", "writes", "longPolls")
+
+    def __init__(self, maxInFlight=None, maxReads=None, maxWrites=None,
+                 rateLimit=None, rateBurst=None, retryAfter=1, maxLongPolls=None):
+        self.maxInFlight = maxInFlight
+        self.limits = {"reads": maxReads, "writes": maxWrites, "longPolls": maxLongPolls}
+        self.rateLimit = rateLimit
+        if rateBurst is None and rateLimit is not None:
+            rateBurst = max(1, rateLimit)
+        if rateBurst is not None and rateBurst < 1:
+            raise ValueError("rateBurst must be at least 1")
+        self.rateBurst = rateBurst
+        self.retryAfter = retryAfter
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.inFlight = {"reads": 0, "writes": 0, "longPolls": 0}
+        self.counters = {
+            "admitted": 0,
+            "rejectedInFlight": 0,
+            "rejectedReads": 0,
+            "rejectedWrites": 0,
+            "rejectedLongPolls": 0,
+            "rejectedRateLimit": 0,
+        }
+
+    def admit(self, client, kind):
+        limit = self.limits[kind]
+        with self.lock:
+            # capacity is checked first so a request we cannot serve does not cost the client a token
+            total = self.inFlight["reads"] + self.inFlight["writes"]
+            if kind != "longPolls" and self.maxInFlight is not None and total >= self.maxInFlight:
+                self.counters["rejectedInFlight"] += 1
+                return False
+            if limit is not None and self.inFlight[kind] >= limit:
+                self.counters["rejected" + kind[0].upper() + kind[1:]] += 1
+                return False
+            if self.rateLimit is not None and not self.takeToken(client):
+                self.counters["rejectedRateLimit"] += 1
+                return False
+            self.inFlight[kind] += 1
+            self.counters["admitted"] += 1
+            return True
+
+    def release(self, kind):
+        with self.lock:
+            self.inFlight[kind] -= 1
+
+    # buckets are kept in least-recently-used order; once the table is full the
+    # oldest is evicted, which at worst hands that client a fresh burst
+    def takeToken(self, client):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_TRACKED_CLIENTS:
+                self.buckets.popitem(last=False)
+            bucket = TokenBucket(self.rateLimit, self.rateBurst)
+            self.buckets[client] = bucket
+        else:
+            self.buckets.move_to_end(client)
+        return bucket.take()
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["inFlightReads"] = self.inFlight["reads"]
+            stats["inFlightWrites"] = self.inFlight["writes"]
+            stats["inFlightLongPolls"] = self.inFlight["longPolls"]
+        return stats
+
+class ChangeNotifier:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        with self.condition:
+            if self.version == version:
+                self.condition.wait(timeout)
+            return self.version
+
+changeNotifier = ChangeNotifier()
+
 class SquirrelServerHandler(BaseHTTPRequestHandler):
 
+    MAX_CHANGES_WAIT = 30
+    # larger rejected bodies are left unread, and the client may see a reset instead of the 503
+    MAX_DISCARD_BYTES = 16 * 1024 * 1024
+    # writes from other processes do not notify us, so recheck the db at least this often
+    CHANGES_RECHECK_INTERVAL = 1
+
     # HTTP METHODS
 
     def do_GET(self):
+        # stats must stay readable when the server is saturated, so they skip admission
+        if self.parsePath() == ("_admission", None):
+            self.handleAdmissionStats()
+            return
+        self.handleAdmitted("longPolls" if self.isLongPoll() else "reads", self.routeGET)
+
+    def do_POST(self):
+        self.handleAdmitted("writes", self.routePOST)
+
+    def do_PUT(self):
+        self.handleAdmitted("writes", self.routePUT)
+
+    def do_DELETE(self):
+        self.handleAdmitted("writes", self.routeDELETE)
+
+    # ROUTES
+
+    def routeGET(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
-            if resourceId:
+            if resourceId == "_changes":
+                self.handleSquirrelsChanges()
+            elif resourceId:
                 self.handleSquirrelsRetrieve(resourceId)
             else:
                 self.handleSquirrelsIndex()
         else:
             self.handle404()
 
-    def do_POST(self):
+    def routePOST(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
@@ -27,7 +169,7 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         else:
             self.handle404()
 
-    def do_PUT(self):
+    def routePUT(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
@@ -37,7 +179,7 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         else:
             self.handle404()
 
-    def do_DELETE(self):
+    def routeDELETE(self):
         resourceName, resourceId = self.parsePath()
         if resourceName == "squirrels":
             if resourceId:
@@ -49,6 +191,41 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
 
     # HELPERS
 
+    def isLongPoll(self):
+        if self.parsePath() != ("squirrels", "_changes"):
+            return False
+        try:
+            return float(self.getQueryParams().get("wait", 0)) > 0
+        except ValueError:
+            return False
+
+    def handleAdmitted(self, kind, route):
+        admission = getattr(self.server, "admission", None)
+        if admission is None:
+            route()
+            return
+        if not admission.admit(self.client_address[0], kind):
+            self.discardRequestBody()
+            self.handle503(admission.retryAfter)
+            return
+        try:
+            route()
+        finally:
+            admission.release(kind)
+
+    # closing a socket with unread input makes the kernel reset the connection,
+    # so a rejected body is drained before the 503 is sent
+    def discardRequestBody(self):
+        try:
+            remaining = min(int(self.headers.get("Content-Length") or 0), self.MAX_DISCARD_BYTES)
+        except ValueError:
+            remaining = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 65536))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
     def getRequestData(self):
         length = int(self.headers["Content-Length"])
         body = self.rfile.read(length).decode("utf-8")
@@ -57,9 +234,16 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
             data[key] = data[key][0]
         return data
 
+    def getQueryParams(self):
+        data = parse_qs(urlsplit(self.path).query)
+        for key in data:
+            data[key] = data[key][0]
+        return data
+
     def parsePath(self):
-        if self.path.startswith("/"):
-            parts = self.path[1:].split("/")
+        path = urlsplit(self.path).path
+        if path.startswith("/"):
+            parts = path[1:].split("/")
             resourceName = parts[0]
             resourceId = None
             if len(parts) > 1:
@@ -92,6 +276,7 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         db = SquirrelDB()
         body = self.getRequestData()
         db.createSquirrel(body["name"], body["size"])
+        changeNotifier.notify()
         self.send_response(201)
         self.end_headers()
 
@@ -101,6 +286,7 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         if squirrel:
             body = self.getRequestData()
             db.updateSquirrel(squirrelId, body["name"], body["size"])
+            changeNotifier.notify()
             self.send_response(204)
             self.end_headers()
         else:
@@ -111,21 +297,78 @@ class SquirrelServerHandler(BaseHTTPRequestHandler):
         squirrel = db.getSquirrel(squirrelId)
         if squirrel:
             db.deleteSquirrel(squirrelId)
+            changeNotifier.notify()
             self.send_response(204)
             self.end_headers()
         else:
             self.handle404()
 
+    def handleSquirrelsChanges(self):
+        query = self.getQueryParams()
+        since = query.get("since", 0)
+        try:
+            since = None if since == "now" else int(since)
+            wait = max(0.0, min(float(query.get("wait", 0)), self.MAX_CHANGES_WAIT))
+        except ValueError:
+            self.handle400()
+            return
+        db = SquirrelDB()
+        if since is None:
+            since = db.getLastSeq()
+        deadline = time.monotonic() + wait
+        while True:
+            version = changeNotifier.version
+            changes = db.getChanges(since)
+            remaining = deadline - time.monotonic()
+            if changes or remaining <= 0:
+                break
+            changeNotifier.wait(version, min(remaining, self.CHANGES_RECHECK_INTERVAL))
+        # a page is capped by getChanges' limit, so last_seq can trail the head of the log
+        headSeq = db.getLastSeq()
+        lastSeq = changes[-1]["seq"] if changes else headSeq
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps({"changes": changes, "last_seq": lastSeq, "head_seq": headSeq}), "utf-8"))
+
+    def handleAdmissionStats(self):
+        admission = getattr(self.server, "admission", None)
+        if admission is None:
+            self.handle404()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(bytes(json.dumps(admission.snapshot()), "utf-8"))
+
+    def handle400(self):
+        self.send_response(400)
+        self.send_header("Content-Type", "text/plain")
+        self.end_headers()
+        self.wfile.write(bytes("400 Bad Request", "utf-8"))
+
     def handle404(self):
         self.send_response(404)
         self.send_header("Content-Type", "text/plain")
         self.end_headers()
         self.wfile.write(bytes("404 Not Found", "utf-8"))
 
-def run():
+    def handle503(self, retryAfter):
+        self.send_response(503)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Retry-After", str(retryAfter))
+        self.send_header("Connection", "close")
+        self.close_connection = True
+        self.end_headers()
+        self.wfile.write(bytes("503 Service Unavailable", "utf-8"))
+
+def run(maxInFlight=64, maxReads=None, maxWrites=None,
+        rateLimit=None, rateBurst=None, retryAfter=1, maxLongPolls=256):
     print("squirrel_server running at 127.0.0.1:8080")
     listen = ("127.0.0.1", 8080)
-    server = HTTPServer(listen, SquirrelServerHandler)
+    server = ThreadingHTTPServer(listen, SquirrelServerHandler)
+    server.admission = AdmissionController(maxInFlight, maxReads, maxWrites,
+                                           rateLimit, rateBurst, retryAfter, maxLongPolls)
     server.serve_forever()
 
 if __name__ == '__main__':
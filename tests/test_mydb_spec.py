@@ -1,14 +1,16 @@
 import os, sys 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import subprocess
 import types
 import pytest
-from mydb import MyDB
+from mydb import MyDB, ShardedMyDB, shardFilename, rebalanceShards
 
 class _DummyFile:
     def __init__(self, name): self.name = name
     def __enter__(self): return self
     def __exit__(self, exc_type, exc, tb): pass
+    def write(self, data): pass
 
 @pytest.fixture
 def fs_stubs(mocker):
@@ -31,6 +33,20 @@ def fs_stubs(mocker):
         load_mock=load_mock, dump_mock=dump_mock
     )
 
+@pytest.fixture
+def shard_fs(fs_stubs, mocker):
+    """
+    fs_stubs plus an in-memory view of which files exist, so ShardedMyDB's
+    shard, counter and metadata files are created, replaced and removed in memdb.
+    """
+    memdb = fs_stubs.memdb
+    mocker.patch("mydb.os.path.isfile", side_effect=lambda name: name in memdb)
+    fs_stubs.remove_mock = mocker.patch("mydb.os.remove",
+                                        side_effect=lambda name: memdb.pop(name, None))
+    fs_stubs.replace_mock = mocker.patch("mydb.os.replace",
+                                         side_effect=lambda src, dst: memdb.__setitem__(dst, memdb.pop(src)))
+    return fs_stubs
+
 def describe_MyDB():
 
     def describe___init__():
@@ -152,3 +168,286 @@ def describe_MyDB():
             db.saveString("b")
             load_mock.assert_called_once_with()
             save_mock.assert_called_once_with(["a", "b"])
+
+def describe_shardFilename():
+    def it_inserts_shard_index_before_extension():
+        assert shardFilename("data.db", 2) == "data.2.db"
+
+    def it_appends_shard_index_without_extension():
+        assert shardFilename("data", 0) == "data.0"
+
+    def it_prefixes_later_generations():
+        assert shardFilename("data.db", 2, 3) == "data.g3.2.db"
+
+def describe_ShardedMyDB():
+
+    def describe___init__():
+        def it_wraps_one_mydb_per_shard(shard_fs):
+            db = ShardedMyDB("s.db", 3)
+            assert [shard.fname for shard in db.shards] == ["s.0.db", "s.1.db", "s.2.db"]
+
+        def it_rejects_zero_shards(shard_fs):
+            with pytest.raises(ValueError):
+                ShardedMyDB("s.db", 0)
+
+        def it_records_shard_count_on_first_open(shard_fs):
+            ShardedMyDB("s.db", 3)
+            assert shard_fs.memdb["s.meta.db"] == [3, 0]
+
+        # verifies a stale shard count fails loudly instead of reading the wrong layout
+        def it_rejects_shard_count_that_does_not_match_metadata(shard_fs):
+            shard_fs.memdb["s.meta.db"] = [4, 0]
+            with pytest.raises(ValueError):
+                ShardedMyDB("s.db", 2)
+            with pytest.raises(ValueError):
+                ShardedMyDB("s.db", 6)
+            assert not [name for name in shard_fs.memdb if name.startswith("s.") and name[2].isdigit()]
+
+        def it_opens_shards_of_the_recorded_generation(shard_fs):
+            shard_fs.memdb["s.meta.db"] = [2, 3]
+            shard_fs.memdb["s.g3.0.db"] = [(0, "a")]
+            shard_fs.memdb["s.g3.1.db"] = [(1, "b")]
+            db = ShardedMyDB("s.db", 2)
+            assert [shard.fname for shard in db.shards] == ["s.g3.0.db", "s.g3.1.db"]
+            assert db.loadStrings() == ["a", "b"]
+
+        # verifies a recorded layout with a lost shard is refused rather than recreated empty
+        def it_rejects_missing_shard_files(shard_fs):
+            shard_fs.memdb["s.meta.db"] = [2, 0]
+            shard_fs.memdb["s.0.db"] = [(0, "a")]
+            with pytest.raises(ValueError):
+                ShardedMyDB("s.db", 2)
+            assert "s.1.db" not in shard_fs.memdb
+
+    def describe_shardIndex():
+        # verifies partitioning is stable across instances (no per-process hash seed)
+        def it_is_deterministic_and_in_range(shard_fs):
+            a = ShardedMyDB("s.db", 4)
+            b = ShardedMyDB("s.db", 4)
+            for s in ["x", "y", "squirrel", "Árvíztűrő"]:
+                assert a.shardIndex(s) == b.shardIndex(s)
+                assert 0 <= a.shardIndex(s) < 4
+
+    def describe_loadStrings():
+        # verifies the ordered merge restores global insertion order across shards
+        def it_merges_shards_in_insertion_order(shard_fs, mocker):
+            shard_fs.memdb["s.0.db"] = [(0, "a"), (3, "d")]
+            shard_fs.memdb["s.1.db"] = [(1, "b"), (2, "c")]
+            db = ShardedMyDB("s.db", 2)
+            assert db.loadStrings() == ["a", "b", "c", "d"]
+
+        def it_concatenates_shards_when_order_not_needed(shard_fs, mocker):
+            shard_fs.memdb["s.0.db"] = [(0, "a"), (3, "d")]
+            shard_fs.memdb["s.1.db"] = [(1, "b"), (2, "c")]
+            db = ShardedMyDB("s.db", 2)
+            assert db.loadStrings(ordered=False) == ["a", "d", "b", "c"]
+
+        def it_returns_empty_list_for_empty_shards(shard_fs, mocker):
+            shard_fs.memdb["s.0.db"] = []
+            shard_fs.memdb["s.1.db"] = []
+            db = ShardedMyDB("s.db", 2)
+            assert db.loadStrings() == []
+
+    def describe_saveStrings():
+        def it_partitions_by_hash_and_round_trips(shard_fs, mocker):
+            db = ShardedMyDB("s.db", 3)
+            words = ["the", "quick", "brown", "fox", "jumps"]
+            db.saveStrings(words)
+            for s in words:
+                assert s in [entry[1] for entry in shard_fs.memdb["s.%d.db" % db.shardIndex(s)]]
+            assert shard_fs.memdb["s.seq.db"] == [5]
+            assert db.loadStrings() == words
+
+    def describe_saveString():
+        # verifies a single append touches the lock, the counter and only the target shard
+        def it_writes_only_the_target_shard(shard_fs, mocker):
+            remove_mock = shard_fs.remove_mock
+            db = ShardedMyDB("s.db", 3)
+            db.saveStrings(["a", "b"])
+            del shard_fs.open_calls[:]
+
+            db.saveString("c")
+
+            target = "s.%d.db" % db.shardIndex("c")
+            assert shard_fs.open_calls == [
+                ("s.lock.db", "x"), ("s.seq.db", "rb"), ("s.seq.db", "wb"), (target, "rb"), (target, "wb"),
+            ]
+            assert shard_fs.memdb[target][-1] == (2, "c")
+            remove_mock.assert_called_with("s.lock.db")
+
+        def it_continues_sequence_from_existing_shards(shard_fs, mocker):
+            shard_fs.memdb["s.0.db"] = [(0, "a")]
+            shard_fs.memdb["s.1.db"] = [(5, "b")]
+            shard_fs.memdb["s.seq.db"] = []
+            db = ShardedMyDB("s.db", 2)
+            db.saveString("c")
+            assert db.loadStrings() == ["a", "b", "c"]
+            assert shard_fs.memdb["s.seq.db"] == [7]
+
+        # verifies separate instances share one counter instead of reusing sequence numbers
+        def it_shares_sequence_between_instances(shard_fs, mocker):
+            first = ShardedMyDB("s.db", 2)
+            first.saveStrings([])
+            second = ShardedMyDB("s.db", 2)
+
+            for i, s in enumerate(["a", "b", "c", "d", "e", "f"]):
+                (first if i % 2 else second).saveString(s)
+
+            assert first.loadStrings() == ["a", "b", "c", "d", "e", "f"]
+            for name in ["s.0.db", "s.1.db"]:
+                seqs = [entry[0] for entry in shard_fs.memdb[name]]
+                assert seqs == sorted(seqs)
+
+        def it_releases_lock_when_write_fails(shard_fs, mocker):
+            remove_mock = shard_fs.remove_mock
+            shard_fs.memdb["s.seq.db"] = [0]
+            db = ShardedMyDB("s.db", 2)
+            remove_mock.reset_mock()
+            mocker.patch.object(MyDB, "saveString", side_effect=RuntimeError("disk full"))
+
+            with pytest.raises(RuntimeError):
+                db.saveString("a")
+
+            remove_mock.assert_called_once_with("s.lock.db")
+
+    def describe_writeLock():
+        # verifies a writer gives up instead of waiting forever on a held lock
+        def it_times_out_when_lock_is_held(tmp_path, mocker):
+            mocker.patch.object(ShardedMyDB, "LOCK_TIMEOUT", 0)
+            db = ShardedMyDB(str(tmp_path / "s.db"), 2)
+            (tmp_path / "s.lock.db").write_text("")
+
+            with pytest.raises(TimeoutError) as err:
+                db.saveString("a")
+
+            assert "s.lock.db" in str(err.value)
+            assert "deleted" in str(err.value)
+            assert db.loadStrings() == []
+
+        def it_records_holder_pid_in_lock_file(tmp_path):
+            db = ShardedMyDB(str(tmp_path / "s.db"), 2)
+            with db.writeLock():
+                assert (tmp_path / "s.lock.db").read_text() == str(os.getpid())
+            assert not (tmp_path / "s.lock.db").exists()
+
+        # verifies a lock left by a process that has exited is broken automatically
+        @pytest.mark.skipif(os.name != "posix", reason="holder liveness is only checked on POSIX")
+        def it_breaks_lock_left_by_dead_process(tmp_path, mocker):
+            mocker.patch.object(ShardedMyDB, "LOCK_TIMEOUT", 0)
+            db = ShardedMyDB(str(tmp_path / "s.db"), 2)
+            dead = subprocess.Popen([sys.executable, "-c", "pass"])
+            dead.wait()
+            (tmp_path / "s.lock.db").write_text(str(dead.pid))
+
+            db.saveString("a")
+
+            assert db.loadStrings() == ["a"]
+            assert not list(tmp_path.glob("s.lock*"))
+
+        def it_waits_on_lock_held_by_live_process(tmp_path, mocker):
+            mocker.patch.object(ShardedMyDB, "LOCK_TIMEOUT", 0)
+            db = ShardedMyDB(str(tmp_path / "s.db"), 2)
+            (tmp_path / "s.lock.db").write_text(str(os.getpid()))
+
+            with pytest.raises(TimeoutError):
+                db.saveString("a")
+
+            assert (tmp_path / "s.lock.db").read_text() == str(os.getpid())
+
+def describe_rebalanceShards():
+    def it_grows_shard_count_preserving_order(tmp_path):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 2).saveStrings(["a", "b", "c", "d"])
+
+        rebalanceShards(fname, 2, 4)
+
+        with pytest.raises(ValueError):
+            ShardedMyDB(fname, 2)
+        db = ShardedMyDB(fname, 4)
+        assert db.loadStrings() == ["a", "b", "c", "d"]
+        db.saveString("e")
+        assert db.loadStrings()[-1] == "e"
+        assert not list(tmp_path.glob("*.tmp"))
+
+    # verifies shrinking rewrites the survivors before removing the extra shard files
+    def it_shrinks_shard_count_and_removes_extra_files(tmp_path):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 3).saveStrings(["a", "b", "c"])
+
+        rebalanceShards(fname, 3, 1)
+
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["s.g1.0.db", "s.meta.db", "s.seq.db"]
+        assert ShardedMyDB(fname, 1).loadStrings() == ["a", "b", "c"]
+
+    # verifies an understated oldCount is refused instead of overwriting unread shards
+    def it_rejects_old_count_smaller_than_actual(tmp_path):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 4).saveStrings(["a", "b", "c", "d"])
+
+        with pytest.raises(ValueError):
+            rebalanceShards(fname, 2, 4)
+
+        assert ShardedMyDB(fname, 4).loadStrings() == ["a", "b", "c", "d"]
+
+    def it_rejects_missing_shard_files(tmp_path):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 2).saveStrings(["a", "b"])
+        (tmp_path / "s.1.db").unlink()
+
+        with pytest.raises(ValueError):
+            rebalanceShards(fname, 2, 3)
+
+    # verifies a crash before the metadata switch leaves the old layout fully in use
+    def it_keeps_old_layout_when_interrupted_before_switch(tmp_path, mocker):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 2).saveStrings(["a", "b", "c"])
+        mocker.patch("mydb.os.replace", side_effect=OSError("killed"))
+
+        with pytest.raises(OSError):
+            rebalanceShards(fname, 2, 3)
+
+        mocker.stopall()
+        assert ShardedMyDB(fname, 2).loadStrings() == ["a", "b", "c"]
+        with pytest.raises(ValueError):
+            ShardedMyDB(fname, 3)
+
+    # verifies a crash after the switch only leaves unreferenced old files behind
+    def it_uses_new_layout_when_interrupted_after_switch(tmp_path, mocker):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 2).saveStrings(["a", "b", "c"])
+        real_remove = os.remove
+
+        def crash_on_old_shard(name):
+            if name.endswith("s.1.db"):
+                raise OSError("killed")
+            real_remove(name)
+
+        mocker.patch("mydb.os.remove", side_effect=crash_on_old_shard)
+
+        with pytest.raises(OSError):
+            rebalanceShards(fname, 2, 3)
+
+        mocker.stopall()
+        assert (tmp_path / "s.1.db").exists()
+        assert ShardedMyDB(fname, 3).loadStrings() == ["a", "b", "c"]
+
+    # verifies a failed write leaves the original shards untouched and no temp files behind
+    def it_keeps_original_shards_when_a_write_fails(tmp_path, mocker):
+        fname = str(tmp_path / "s.db")
+        ShardedMyDB(fname, 2).saveStrings(["a", "b", "c"])
+        before = {p.name: p.read_bytes() for p in tmp_path.iterdir()}
+        real_save = MyDB.saveStrings
+        calls = []
+
+        def flaky_save(self, arr):
+            calls.append(self.fname)
+            if len(calls) == 2:
+                raise OSError("disk full")
+            real_save(self, arr)
+
+        mocker.patch.object(MyDB, "saveStrings", flaky_save)
+
+        with pytest.raises(OSError):
+            rebalanceShards(fname, 2, 3)
+
+        assert {p.name: p.read_bytes() for p in tmp_path.iterdir()} == before
@@ -1,10 +1,13 @@
 import os, sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import io
 import json
+import sqlite3
 import pytest
 
-from squirrel_server import SquirrelServerHandler
+from squirrel_db import SquirrelDB
+from squirrel_server import SquirrelServerHandler, TokenBucket, AdmissionController, ChangeNotifier
 
 
 
@@ -35,6 +38,111 @@ def handler_base(mocker):
     return h
 
 
+@pytest.fixture
+def squirrel_db_file(tmp_path, monkeypatch):
+    """
+    SquirrelDB always opens ./squirrel_db.db, so run it inside a temp dir
+    holding a fresh copy of the schema (never the checked-in db).
+    """
+    monkeypatch.chdir(tmp_path)
+    conn = sqlite3.connect("squirrel_db.db")
+    conn.execute("CREATE TABLE squirrels (id INTEGER PRIMARY KEY, name TEXT, size TEXT)")
+    conn.commit()
+    conn.close()
+    return tmp_path / "squirrel_db.db"
+
+
+def describe_SquirrelDB():
+
+    def describe_change_log():
+        def it_logs_create_update_delete_with_increasing_seq(squirrel_db_file):
+            db = SquirrelDB()
+            db.createSquirrel("Nutmeg", "S")
+            db.createSquirrel("Chonk", "L")
+            db.updateSquirrel(1, "Nutmeg", "M")
+            db.deleteSquirrel(2)
+
+            changes = db.getChanges(0)
+            assert [(c["seq"], c["op"], c["id"]) for c in changes] == [
+                (1, "create", 1), (2, "create", 2), (3, "update", 1), (4, "delete", 2),
+            ]
+            assert changes[2]["size"] == "M"
+            assert changes[3]["name"] is None
+
+        # verifies mutations that match no row leave the log untouched
+        def it_does_not_log_updates_or_deletes_that_match_nothing(squirrel_db_file):
+            db = SquirrelDB()
+            db.updateSquirrel(99, "Ghost", "S")
+            db.deleteSquirrel(99)
+            assert db.getChanges(0) == []
+            assert db.getLastSeq() == 0
+
+        # verifies URL ids that SQLite matches as integers are logged normalized, not rejected
+        def it_accepts_non_canonical_integer_ids(squirrel_db_file):
+            db = SquirrelDB()
+            db.createSquirrel("Nutmeg", "S")
+            db.updateSquirrel("1.0", "Nutmeg", "M")
+            db.deleteSquirrel("1e0")
+            assert [(c["op"], c["id"]) for c in db.getChanges(1)] == [("update", 1), ("delete", 1)]
+
+        # verifies the change row commits or rolls back together with its mutation
+        def it_writes_change_in_same_transaction_as_mutation(squirrel_db_file, mocker):
+            db = SquirrelDB()
+            mocker.patch.object(SquirrelDB, "logChange", side_effect=RuntimeError("log failed"))
+            with pytest.raises(RuntimeError):
+                db.createSquirrel("Nutmeg", "S")
+
+            other = sqlite3.connect(str(squirrel_db_file))
+            assert other.execute("SELECT COUNT(*) FROM squirrels").fetchone()[0] == 0
+            other.close()
+
+        def it_seq_keeps_increasing_across_connections(squirrel_db_file):
+            SquirrelDB().createSquirrel("A", "S")
+            SquirrelDB().createSquirrel("B", "S")
+            db = SquirrelDB()
+            db.deleteSquirrel(1)
+            assert [c["seq"] for c in db.getChanges(0)] == [1, 2, 3]
+
+    def describe_getChanges():
+        def it_returns_only_changes_after_since(squirrel_db_file):
+            db = SquirrelDB()
+            for name in ["A", "B", "C"]:
+                db.createSquirrel(name, "S")
+            assert [c["name"] for c in db.getChanges(1)] == ["B", "C"]
+            assert db.getChanges(3) == []
+
+        def it_honours_limit_in_seq_order(squirrel_db_file):
+            db = SquirrelDB()
+            for name in ["A", "B", "C"]:
+                db.createSquirrel(name, "S")
+            assert [c["seq"] for c in db.getChanges(0, limit=2)] == [1, 2]
+
+    def describe_getLastSeq():
+        def it_is_zero_for_empty_log(squirrel_db_file):
+            assert SquirrelDB().getLastSeq() == 0
+
+        def it_returns_highest_seq(squirrel_db_file):
+            db = SquirrelDB()
+            db.createSquirrel("A", "S")
+            db.createSquirrel("B", "S")
+            assert db.getLastSeq() == 2
+
+    def describe_createChangeLog():
+        # verifies squirrels that predate the log are seeded as creates exactly once
+        def it_seeds_existing_squirrels_once(squirrel_db_file):
+            conn = sqlite3.connect(str(squirrel_db_file))
+            conn.execute("INSERT INTO squirrels (name, size) VALUES ('A', 'S'), ('B', 'L')")
+            conn.commit()
+            conn.close()
+
+            SquirrelDB()
+            db = SquirrelDB()
+
+            assert [(c["op"], c["id"], c["name"]) for c in db.getChanges(0)] == [
+                ("create", 1, "A"), ("create", 2, "B"),
+            ]
+
+
 def describe_SquirrelServerHandler():
 
     #  handleSquirrelsIndex 
@@ -178,6 +286,17 @@ def describe_SquirrelServerHandler():
             h.end_headers.assert_called_once()
             assert h.wfile.buffer == b""
 
+        # verifies long-poll waiters are woken after a create
+        def it_notifies_change_waiters(handler_base, mocker):
+            h = handler_base
+            h.getRequestData.return_value = {"name": "Newt", "size": "medium"}
+            mocker.patch("squirrel_server.SquirrelDB")
+            notify = mocker.patch("squirrel_server.changeNotifier.notify")
+
+            h.handleSquirrelsCreate()
+
+            notify.assert_called_once_with()
+
         # verifies that 201 response has no body and no Content-Type header is set
         def it_returns_201_with_no_body_and_no_content_type(handler_base, mocker):
             h = handler_base
@@ -366,3 +485,422 @@ def describe_SquirrelServerHandler():
 
             assert h.wfile.buffer == b"404 Not Found"
 
+
+
+    #  handleSquirrelsChanges
+    def describe_handleSquirrelsChanges():
+        def it_returns_changes_after_since(handler_base, mocker):
+            h = handler_base
+            h.path = "/squirrels/_changes?since=4"
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            SquirrelDB_cls = mocker.patch("squirrel_server.SquirrelDB")
+            SquirrelDB_cls.return_value.getChanges.return_value = [
+                {"seq": 5, "op": "create", "id": 3, "name": "Newt", "size": "M"},
+                {"seq": 6, "op": "delete", "id": 2, "name": None, "size": None},
+            ]
+            SquirrelDB_cls.return_value.getLastSeq.return_value = 6
+
+            h.handleSquirrelsChanges()
+
+            SquirrelDB_cls.return_value.getChanges.assert_called_once_with(4)
+            h.send_response.assert_called_once_with(200)
+            h.send_header.assert_any_call("Content-Type", "application/json")
+            body = json.loads(h.wfile.buffer.decode("utf-8"))
+            assert [c["seq"] for c in body["changes"]] == [5, 6]
+            assert body["last_seq"] == 6
+
+        # verifies an empty poll without wait returns immediately with the current sequence
+        def it_returns_empty_list_and_last_seq_without_waiting(handler_base, mocker):
+            h = handler_base
+            h.path = "/squirrels/_changes?since=9"
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            SquirrelDB_cls = mocker.patch("squirrel_server.SquirrelDB")
+            SquirrelDB_cls.return_value.getChanges.return_value = []
+            SquirrelDB_cls.return_value.getLastSeq.return_value = 9
+            wait = mocker.patch("squirrel_server.changeNotifier.wait")
+
+            h.handleSquirrelsChanges()
+
+            wait.assert_not_called()
+            body = json.loads(h.wfile.buffer.decode("utf-8"))
+            assert body == {"changes": [], "last_seq": 9, "head_seq": 9}
+
+        # verifies long-poll waits for a notification and then re-reads the log
+        def it_long_polls_until_changes_arrive(handler_base, mocker):
+            h = handler_base
+            h.path = "/squirrels/_changes?since=1&wait=10"
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            SquirrelDB_cls = mocker.patch("squirrel_server.SquirrelDB")
+            SquirrelDB_cls.return_value.getChanges.side_effect = [
+                [], [{"seq": 2, "op": "update", "id": 1, "name": "A", "size": "S"}],
+            ]
+            SquirrelDB_cls.return_value.getLastSeq.return_value = 2
+            wait = mocker.patch("squirrel_server.changeNotifier.wait")
+
+            h.handleSquirrelsChanges()
+
+            wait.assert_called_once()
+            assert SquirrelDB_cls.return_value.getChanges.call_count == 2
+            body = json.loads(h.wfile.buffer.decode("utf-8"))
+            assert body["last_seq"] == 2
+
+        # verifies a full page reports where it stopped and, separately, the head of the log
+        def it_reports_head_seq_when_page_is_full(handler_base, mocker):
+            h = handler_base
+            h.path = "/squirrels/_changes"
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            SquirrelDB_cls = mocker.patch("squirrel_server.SquirrelDB")
+            SquirrelDB_cls.return_value.getChanges.return_value = [
+                {"seq": seq, "op": "create", "id": seq, "name": "S%d" % seq, "size": "M"}
+                for seq in range(1, 1001)
+            ]
+            SquirrelDB_cls.return_value.getLastSeq.return_value = 1500
+
+            h.handleSquirrelsChanges()
+
+            SquirrelDB_cls.return_value.getChanges.assert_called_once_with(0)
+            body = json.loads(h.wfile.buffer.decode("utf-8"))
+            assert len(body["changes"]) == 1000
+            assert body["last_seq"] == 1000
+            assert body["head_seq"] == 1500
+
+        # verifies since=now starts at the head without returning any history
+        def it_starts_at_head_for_since_now(handler_base, mocker):
+            h = handler_base
+            h.path = "/squirrels/_changes?since=now"
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            SquirrelDB_cls = mocker.patch("squirrel_server.SquirrelDB")
+            SquirrelDB_cls.return_value.getLastSeq.return_value = 1500
+            SquirrelDB_cls.return_value.getChanges.return_value = []
+
+            h.handleSquirrelsChanges()
+
+            SquirrelDB_cls.return_value.getChanges.assert_called_once_with(1500)
+            body = json.loads(h.wfile.buffer.decode("utf-8"))
+            assert body == {"changes": [], "last_seq": 1500, "head_seq": 1500}
+
+        def it_returns_400_on_bad_since(handler_base, mocker):
+            h = handler_base
+            h.path = "/squirrels/_changes?since=abc"
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            SquirrelDB_cls = mocker.patch("squirrel_server.SquirrelDB")
+
+            h.handleSquirrelsChanges()
+
+            SquirrelDB_cls.assert_not_called()
+            h.send_response.assert_called_once_with(400)
+            assert h.wfile.buffer == b"400 Bad Request"
+
+
+    #  parsePath
+    def describe_parsePath():
+        # verifies the query string is not mistaken for part of the resource id
+        def it_ignores_query_string(handler_base):
+            h = handler_base
+            h.path = "/squirrels/_changes?since=3"
+            h.parsePath = SquirrelServerHandler.parsePath.__get__(h, SquirrelServerHandler)
+
+            assert h.parsePath() == ("squirrels", "_changes")
+
+
+    #  handle503
+    def describe_handle503():
+        # verifies the rejection is fast, plain-text, and tells the client when to retry
+        def it_writes_503_with_retry_after(handler_base):
+            h = handler_base
+            h.handle503(3)
+
+            h.send_response.assert_called_once_with(503)
+            h.send_header.assert_any_call("Content-Type", "text/plain")
+            h.send_header.assert_any_call("Retry-After", "3")
+            h.send_header.assert_any_call("Connection", "close")
+            assert h.close_connection
+            h.end_headers.assert_called_once()
+            assert h.wfile.buffer == b"503 Service Unavailable"
+
+
+    #  handleAdmitted
+    def describe_handleAdmitted():
+        def it_runs_route_without_admission_controller(handler_base, mocker):
+            h = handler_base
+            h.server = object()
+            route = mocker.Mock()
+
+            h.handleAdmitted("reads", route)
+
+            route.assert_called_once_with()
+
+        def it_runs_route_and_releases_slot_when_admitted(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.client_address = ("10.0.0.1", 5555)
+            h.server.admission.admit.return_value = True
+            route = mocker.Mock()
+
+            h.handleAdmitted("writes", route)
+
+            h.server.admission.admit.assert_called_once_with("10.0.0.1", "writes")
+            route.assert_called_once_with()
+            h.server.admission.release.assert_called_once_with("writes")
+
+        # verifies the slot is released even when the route raises
+        def it_releases_slot_when_route_raises(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.client_address = ("10.0.0.1", 5555)
+            h.server.admission.admit.return_value = True
+            route = mocker.Mock(side_effect=RuntimeError("boom"))
+
+            with pytest.raises(RuntimeError):
+                h.handleAdmitted("reads", route)
+
+            h.server.admission.release.assert_called_once_with("reads")
+
+        # verifies a change-feed request with wait is admitted as a long-poll, not a read
+        def it_admits_waiting_change_feed_gets_as_long_polls(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.client_address = ("10.0.0.1", 5555)
+            h.parsePath = SquirrelServerHandler.parsePath.__get__(h, SquirrelServerHandler)
+            h.getQueryParams = SquirrelServerHandler.getQueryParams.__get__(h, SquirrelServerHandler)
+            h.routeGET = mocker.Mock()
+
+            h.path = "/squirrels/_changes?since=3&wait=20"
+            h.do_GET()
+            h.path = "/squirrels/_changes?since=3"
+            h.do_GET()
+            h.path = "/squirrels"
+            h.do_GET()
+
+            kinds = [c.args[1] for c in h.server.admission.admit.call_args_list]
+            assert kinds == ["longPolls", "reads", "reads"]
+
+        def it_rejects_with_503_when_not_admitted(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.client_address = ("10.0.0.1", 5555)
+            h.server.admission.admit.return_value = False
+            h.server.admission.retryAfter = 2
+            h.headers = {}
+            h.handle503 = mocker.Mock()
+            route = mocker.Mock()
+
+            h.handleAdmitted("reads", route)
+
+            route.assert_not_called()
+            h.server.admission.release.assert_not_called()
+            h.handle503.assert_called_once_with(2)
+
+        # verifies a rejected body is read off the socket so the client gets the 503, not a reset
+        def it_drains_request_body_before_rejecting(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.client_address = ("10.0.0.1", 5555)
+            h.server.admission.admit.return_value = False
+            body = b"x" * 200000
+            h.headers = {"Content-Length": str(len(body))}
+            h.rfile = io.BytesIO(body + b"next")
+            h.handle503 = mocker.Mock()
+
+            h.handleAdmitted("writes", mocker.Mock())
+
+            assert h.rfile.read() == b"next"
+            h.handle503.assert_called_once()
+
+
+    #  handleAdmissionStats
+    def describe_handleAdmissionStats():
+        def it_returns_counters_as_json(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.server.admission = AdmissionController(maxInFlight=1)
+            h.server.admission.admit("a", "reads")
+            h.server.admission.admit("b", "reads")
+
+            h.handleAdmissionStats()
+
+            h.send_response.assert_called_once_with(200)
+            h.send_header.assert_any_call("Content-Type", "application/json")
+            body = json.loads(h.wfile.buffer.decode("utf-8"))
+            assert body["admitted"] == 1
+            assert body["rejectedInFlight"] == 1
+            assert body["inFlightReads"] == 1
+
+        def it_returns_404_without_admission_controller(handler_base, mocker):
+            h = handler_base
+            h.server = object()
+            h.handle404 = mocker.Mock()
+
+            h.handleAdmissionStats()
+
+            h.handle404.assert_called_once_with()
+
+        # verifies stats are served even when every admission slot is taken
+        def it_bypasses_admission_control(handler_base, mocker):
+            h = handler_base
+            h.server = mocker.Mock()
+            h.path = "/_admission"
+            h.parsePath = SquirrelServerHandler.parsePath.__get__(h, SquirrelServerHandler)
+            h.handleAdmissionStats = mocker.Mock()
+
+            h.do_GET()
+
+            h.handleAdmissionStats.assert_called_once_with()
+            h.server.admission.admit.assert_not_called()
+
+
+    #  discardRequestBody
+    def describe_discardRequestBody():
+        def it_stops_at_max_discard_bytes(handler_base, mocker):
+            h = handler_base
+            mocker.patch.object(SquirrelServerHandler, "MAX_DISCARD_BYTES", 4)
+            h.headers = {"Content-Length": "10"}
+            h.rfile = io.BytesIO(b"0123456789")
+
+            h.discardRequestBody()
+
+            assert h.rfile.read() == b"456789"
+
+        def it_ignores_missing_or_bad_content_length(handler_base):
+            h = handler_base
+            h.rfile = io.BytesIO(b"abc")
+            for headers in [{}, {"Content-Length": "nope"}]:
+                h.headers = headers
+                h.discardRequestBody()
+            assert h.rfile.read() == b"abc"
+
+
+def describe_ChangeNotifier():
+    def it_returns_immediately_when_version_already_moved():
+        notifier = ChangeNotifier()
+        notifier.notify()
+        assert notifier.wait(0, 5) == 1
+
+    def it_times_out_when_nothing_changes():
+        notifier = ChangeNotifier()
+        assert notifier.wait(0, 0.01) == 0
+
+
+def describe_TokenBucket():
+    def it_allows_burst_then_refuses(mocker):
+        mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        bucket = TokenBucket(1, 2)
+        assert bucket.take()
+        assert bucket.take()
+        assert not bucket.take()
+
+    # verifies tokens refill with elapsed time but never exceed the burst size
+    def it_refills_over_time_up_to_burst(mocker):
+        clock = mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        bucket = TokenBucket(2, 2)
+        bucket.take()
+        bucket.take()
+        clock.return_value = 100.5
+        assert bucket.take()
+        assert not bucket.take()
+        clock.return_value = 200.0
+        bucket.refill()
+        assert bucket.tokens == 2
+
+
+def describe_AdmissionController():
+    def it_admits_everything_when_unlimited():
+        ac = AdmissionController()
+        for _ in range(100):
+            assert ac.admit("a", "reads")
+        assert ac.snapshot()["admitted"] == 100
+        assert ac.snapshot()["inFlightReads"] == 100
+
+    def it_rejects_beyond_max_in_flight_and_recovers_on_release():
+        ac = AdmissionController(maxInFlight=2)
+        assert ac.admit("a", "reads")
+        assert ac.admit("b", "writes")
+        assert not ac.admit("c", "reads")
+        ac.release("writes")
+        assert ac.admit("c", "writes")
+        stats = ac.snapshot()
+        assert stats["rejectedInFlight"] == 1
+        assert stats["inFlightReads"] == 1
+        assert stats["inFlightWrites"] == 1
+
+    # verifies reads and writes are limited independently
+    def it_limits_reads_and_writes_separately():
+        ac = AdmissionController(maxReads=1, maxWrites=1)
+        assert ac.admit("a", "reads")
+        assert not ac.admit("a", "reads")
+        assert ac.admit("a", "writes")
+        assert not ac.admit("a", "writes")
+        stats = ac.snapshot()
+        assert stats["rejectedReads"] == 1
+        assert stats["rejectedWrites"] == 1
+
+    def it_rate_limits_per_client(mocker):
+        mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        ac = AdmissionController(rateLimit=1, rateBurst=1)
+        assert ac.admit("a", "reads")
+        assert not ac.admit("a", "reads")
+        assert ac.admit("b", "reads")
+        assert ac.snapshot()["rejectedRateLimit"] == 1
+
+    # verifies a sub-1 rate still lets each client burst one request instead of locking everyone out
+    def it_defaults_burst_to_at_least_one(mocker):
+        mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        ac = AdmissionController(rateLimit=0.5)
+        assert ac.rateBurst == 1
+        assert ac.admit("a", "reads")
+        assert not ac.admit("a", "reads")
+
+    def it_rejects_burst_below_one():
+        with pytest.raises(ValueError):
+            AdmissionController(rateLimit=5, rateBurst=0.5)
+
+    # verifies a capacity rejection does not also spend the client's rate-limit token
+    def it_does_not_spend_token_when_rejected_for_capacity(mocker):
+        mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        ac = AdmissionController(maxInFlight=1, rateLimit=1, rateBurst=1)
+        assert ac.admit("a", "reads")
+        assert not ac.admit("b", "reads")
+        ac.release("reads")
+        assert ac.admit("b", "reads")
+        stats = ac.snapshot()
+        assert stats["rejectedInFlight"] == 1
+        assert stats["rejectedRateLimit"] == 0
+
+    # verifies idle long-polls cannot starve the writes that would wake them
+    def it_does_not_count_long_polls_toward_in_flight_or_reads():
+        ac = AdmissionController(maxInFlight=2, maxReads=1, maxLongPolls=3)
+        for client in ["a", "b", "c"]:
+            assert ac.admit(client, "longPolls")
+        assert ac.admit("w", "writes")
+        assert ac.admit("r", "reads")
+        stats = ac.snapshot()
+        assert stats["inFlightLongPolls"] == 3
+        assert stats["rejectedInFlight"] == 0
+
+    def it_limits_long_polls_separately():
+        ac = AdmissionController(maxLongPolls=1)
+        assert ac.admit("a", "longPolls")
+        assert not ac.admit("b", "longPolls")
+        ac.release("longPolls")
+        assert ac.admit("b", "longPolls")
+        assert ac.snapshot()["rejectedLongPolls"] == 1
+
+    # verifies the least recently seen client is dropped once the client table is full
+    def it_evicts_least_recently_used_bucket_when_full(mocker):
+        mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        mocker.patch.object(AdmissionController, "MAX_TRACKED_CLIENTS", 2)
+        ac = AdmissionController(rateLimit=1, rateBurst=5)
+        ac.admit("a", "reads")
+        ac.admit("b", "reads")
+        ac.admit("a", "reads")
+        ac.admit("c", "reads")
+        assert list(ac.buckets) == ["a", "c"]
+
+    # verifies the table stays bounded even when every tracked client is active
+    def it_stays_bounded_when_all_clients_are_active(mocker):
+        mocker.patch("squirrel_server.time.monotonic", return_value=100.0)
+        mocker.patch.object(AdmissionController, "MAX_TRACKED_CLIENTS", 3)
+        ac = AdmissionController(rateLimit=1)
+        for i in range(50):
+            ac.admit("client-%d" % i, "reads")
+        assert len(ac.buckets) == 3